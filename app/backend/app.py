@@ -7,9 +7,12 @@ import os
 from pathlib import Path
 from typing import Any, AsyncGenerator, Dict, Union, cast
 
+import aiohttp
+import httpx
 from azure.core.credentials import AzureKeyCredential
 from azure.core.credentials_async import AsyncTokenCredential
 from azure.core.exceptions import ResourceNotFoundError
+from azure.core.pipeline.transport import AioHttpTransport
 from azure.identity.aio import DefaultAzureCredential, get_bearer_token_provider
 from azure.keyvault.secrets.aio import SecretClient
 from azure.monitor.opentelemetry import configure_azure_monitor
@@ -160,10 +163,19 @@ async def ask(auth_claims: Dict[str, Any]):
             approach = cast(Approach, current_app.config[CONFIG_ASK_VISION_APPROACH])
         else:
             approach = cast(Approach, current_app.config[CONFIG_ASK_APPROACH])
-        r = await approach.run(
-            request_json["messages"], context=context, session_state=request_json.get("session_state")
+        result = await approach.run(
+            request_json["messages"],
+            stream=request_json.get("stream", False),
+            context=context,
+            session_state=request_json.get("session_state"),
         )
-        return jsonify(r)
+        if isinstance(result, dict):
+            return jsonify(result)
+        else:
+            response = await make_response(format_as_ndjson(result))
+            response.timeout = None  # type: ignore
+            response.mimetype = "application/json-lines"
+            return response
     except Exception as error:
         return error_response(error, "/ask")
 
@@ -363,10 +375,20 @@ async def setup_clients():
     search_credential: Union[AsyncTokenCredential, AzureKeyCredential] = (
         AzureKeyCredential(search_key) if search_key else azure_credential
     )
+    # Keeps more connections alive, and for longer, than the session the Azure SDK creates by default
+    search_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=200, keepalive_timeout=60),
+        # The other settings match the default session, the SDK decompresses responses itself
+        trust_env=True,
+        cookie_jar=aiohttp.DummyCookieJar(),
+        auto_decompress=False,
+    )
     search_client = SearchClient(
         endpoint=f"https://{AZURE_SEARCH_SERVICE}.search.windows.net",
         index_name=AZURE_SEARCH_INDEX,
         credential=search_credential,
+        # The transport owns the session, so closing the search client closes it
+        transport=AioHttpTransport(session=search_session, session_owner=True),
     )
 
     blob_container_client = ContainerClient(
@@ -437,6 +459,11 @@ async def setup_clients():
 
     # Used by the OpenAI SDK
     openai_client: AsyncOpenAI
+    # Shared by all OpenAI calls, keeping more pooled connections alive than the SDK default for concurrent requests
+    openai_http_client = httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=100, keepalive_expiry=30),
+        follow_redirects=True,
+    )
 
     if OPENAI_HOST.startswith("azure"):
         token_provider = get_bearer_token_provider(azure_credential, "https://cognitiveservices.azure.com/.default")
@@ -452,16 +479,19 @@ async def setup_clients():
             api_version=api_version,
             azure_endpoint=endpoint,
             azure_ad_token_provider=token_provider,
+            http_client=openai_http_client,
         )
     elif OPENAI_HOST == "local":
         openai_client = AsyncOpenAI(
             base_url=os.environ["OPENAI_BASE_URL"],
             api_key="no-key-required",
+            http_client=openai_http_client,
         )
     else:
         openai_client = AsyncOpenAI(
             api_key=OPENAI_API_KEY,
             organization=OPENAI_ORGANIZATION,
+            http_client=openai_http_client,
         )
 
     current_app.config[CONFIG_OPENAI_CLIENT] = openai_client
@@ -494,6 +524,7 @@ async def setup_clients():
     current_app.config[CONFIG_CHAT_APPROACH] = ChatReadRetrieveReadApproach(
         search_client=search_client,
         openai_client=openai_client,
+        openai_host=OPENAI_HOST,
         auth_helper=auth_helper,
         chatgpt_model=OPENAI_CHATGPT_MODEL,
         chatgpt_deployment=AZURE_OPENAI_CHATGPT_DEPLOYMENT,
@@ -533,6 +564,7 @@ async def setup_clients():
         current_app.config[CONFIG_CHAT_VISION_APPROACH] = ChatReadRetrieveReadVisionApproach(
             search_client=search_client,
             openai_client=openai_client,
+            openai_host=OPENAI_HOST,
             blob_container_client=blob_container_client,
             auth_helper=auth_helper,
             vision_endpoint=AZURE_VISION_ENDPOINT,
@@ -551,6 +583,7 @@ async def setup_clients():
 
 @bp.after_app_serving
 async def close_clients():
+    await current_app.config[CONFIG_OPENAI_CLIENT].close()
     await current_app.config[CONFIG_SEARCH_CLIENT].close()
     await current_app.config[CONFIG_BLOB_CONTAINER_CLIENT].close()
     if current_app.config.get(CONFIG_USER_BLOB_CONTAINER_CLIENT):
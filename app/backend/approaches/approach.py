@@ -1,6 +1,9 @@
+import asyncio
 import os
 from abc import ABC
+from collections import OrderedDict
 from dataclasses import dataclass
+from functools import cached_property
 from typing import (
     Any,
     AsyncGenerator,
@@ -15,6 +18,7 @@ from typing import (
 from urllib.parse import urljoin
 
 import aiohttp
+import numpy as np
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.models import (
     QueryCaptionResult,
@@ -90,6 +94,114 @@ class ThoughtStep:
     props: Optional[dict[str, Any]] = None
 
 
+class EmbeddingCache:
+    """
+    A least recently used cache of query embeddings, so that repeated queries skip the embedding request.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.embeddings: OrderedDict[tuple[Any, ...], List[float]] = OrderedDict()
+        self.in_flight: dict[tuple[Any, ...], asyncio.Event] = {}
+
+    def get(self, key: tuple[Any, ...]) -> Optional[List[float]]:
+        embedding = self.embeddings.get(key)
+        if embedding is not None:
+            self.embeddings.move_to_end(key)
+        return embedding
+
+    def set(self, key: tuple[Any, ...], embedding: List[float]):
+        self.embeddings[key] = embedding
+        self.embeddings.move_to_end(key)
+        if len(self.embeddings) > self.maxsize:
+            self.embeddings.popitem(last=False)
+
+    async def get_or_compute(self, key: tuple[Any, ...], compute: Callable[[], Awaitable[List[float]]]) -> List[float]:
+        """
+        Returns the cached embedding for the key, computing it on a miss.
+        Concurrent misses on the same key wait for the first one instead of requesting the same embedding again.
+        """
+        while (embedding := self.get(key)) is None:
+            in_flight = self.in_flight.get(key)
+            if in_flight is None:
+                break
+            # If the first request fails, the embedding is still missing and the next waiter computes it
+            await in_flight.wait()
+        if embedding is not None:
+            return embedding
+
+        done = self.in_flight[key] = asyncio.Event()
+        try:
+            embedding = await compute()
+            self.set(key, embedding)
+            return embedding
+        finally:
+            del self.in_flight[key]
+            done.set()
+
+
+# Shared by all approaches, the keys include the model so that different embedding models never collide
+query_embedding_cache = EmbeddingCache(maxsize=256)
+
+FILTER_CACHE_MAXSIZE = 1024
+
+
+class SemanticCache:
+    """
+    A cache of answers looked up by query embedding, so that a question close to an earlier one reuses its answer.
+    Answers are only reused for the same context key, and the oldest answers are evicted first.
+    """
+
+    def __init__(self, maxsize: int, min_similarity: float):
+        self.maxsize = maxsize
+        self.min_similarity = min_similarity
+        # Normalized embeddings quantized to int8, one row per answer, with the scale of each row kept apart.
+        # Both are allocated once the embedding dimensions are known.
+        self.embeddings: Optional[np.ndarray] = None
+        self.scales: Optional[np.ndarray] = None
+        self.context_keys: List[str] = []
+        self.answers: List[Any] = []
+        self.next_index = 0
+
+    @staticmethod
+    def normalize(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    @staticmethod
+    def quantize(vector: np.ndarray) -> tuple[np.ndarray, float]:
+        # Map the largest component to +/-127, so that each vector keeps the full int8 range
+        scale = float(np.max(np.abs(vector))) / 127 or 1.0
+        return np.round(vector / scale).astype(np.int8), scale
+
+    def get(self, embedding: List[float], context_key: str) -> Optional[Any]:
+        if self.embeddings is None or self.scales is None or self.embeddings.shape[1] != len(embedding):
+            return None
+        # The dot product of normalized vectors is their cosine similarity, rescaled here for the quantized rows
+        count = len(self.answers)
+        similarities = (self.embeddings[:count] @ self.normalize(embedding)) * self.scales[:count]
+        for index in np.argsort(similarities)[::-1]:
+            if similarities[index] < self.min_similarity:
+                break
+            if self.context_keys[index] == context_key:
+                return self.answers[index]
+        return None
+
+    def add(self, embedding: List[float], context_key: str, answer: Any):
+        if self.embeddings is None or self.scales is None or self.embeddings.shape[1] != len(embedding):
+            self.embeddings = np.zeros((self.maxsize, len(embedding)), dtype=np.int8)
+            self.scales = np.zeros(self.maxsize, dtype=np.float32)
+            self.context_keys, self.answers, self.next_index = [], [], 0
+        self.embeddings[self.next_index], self.scales[self.next_index] = self.quantize(self.normalize(embedding))
+        if len(self.answers) < self.maxsize:
+            self.context_keys.append(context_key)
+            self.answers.append(answer)
+        else:
+            self.context_keys[self.next_index] = context_key
+            self.answers[self.next_index] = answer
+        self.next_index = (self.next_index + 1) % self.maxsize
+
+
 class Approach(ABC):
     def __init__(
         self,
@@ -117,9 +229,45 @@ class Approach(ABC):
         self.vision_endpoint = vision_endpoint
         self.vision_token_provider = vision_token_provider
 
+    @cached_property
+    def filter_cache(self) -> OrderedDict[tuple[Any, ...], Optional[str]]:
+        # Kept per approach, since the filter also depends on its auth helper
+        return OrderedDict()
+
     def build_filter(self, overrides: dict[str, Any], auth_claims: dict[str, Any]) -> Optional[str]:
-        exclude_category = overrides.get("exclude_category")
-        security_filter = self.auth_helper.build_security_filters(overrides, auth_claims)
+        # The same user sends the same filter with every question, so the filter is only built once per key
+        filter_key = self._filter_key(overrides, auth_claims)
+        if filter_key in self.filter_cache:
+            self.filter_cache.move_to_end(filter_key)
+            return self.filter_cache[filter_key]
+        filter = self._build_filter(filter_key)
+        self.filter_cache[filter_key] = filter
+        if len(self.filter_cache) > FILTER_CACHE_MAXSIZE:
+            self.filter_cache.popitem(last=False)
+        return filter
+
+    @staticmethod
+    def _filter_key(overrides: dict[str, Any], auth_claims: dict[str, Any]) -> tuple[Any, ...]:
+        # Only the values that the filter is built from. This must include every override and claim that
+        # AuthenticationHelper.build_security_filters reads, or a cached filter would ignore the missing one.
+        # test_authenticationhelper checks that it does.
+        return (
+            overrides.get("exclude_category"),
+            bool(overrides.get("use_oid_security_filter")),
+            bool(overrides.get("use_groups_security_filter")),
+            auth_claims.get("oid", ""),
+            tuple(auth_claims.get("groups", [])),
+        )
+
+    def _build_filter(self, filter_key: tuple[Any, ...]) -> Optional[str]:
+        exclude_category, use_oid_security_filter, use_groups_security_filter, oid, groups = filter_key
+        security_filter = self.auth_helper.build_security_filters(
+            {
+                "use_oid_security_filter": use_oid_security_filter,
+                "use_groups_security_filter": use_groups_security_filter,
+            },
+            {"oid": oid, "groups": list(groups)},
+        )
         filters = []
         if exclude_category:
             filters.append("category ne '{}'".format(exclude_category.replace("'", "''")))
@@ -138,6 +286,8 @@ class Approach(ABC):
         minimum_search_score: Optional[float],
         minimum_reranker_score: Optional[float],
     ) -> List[Document]:
+        # Text-only searches leave vector queries out of the request instead of sending an empty list
+        vector_queries = vectors or None
         # Use semantic ranker if requested and if retrieval mode is text or hybrid (vectors + text)
         if use_semantic_ranker and query_text:
             results = await self.search_client.search(
@@ -149,11 +299,11 @@ class Approach(ABC):
                 semantic_configuration_name="default",
                 top=top,
                 query_caption="extractive|highlight-false" if use_semantic_captions else None,
-                vector_queries=vectors,
+                vector_queries=vector_queries,
             )
         else:
             results = await self.search_client.search(
-                search_text=query_text or "", filter=filter, top=top, vector_queries=vectors
+                search_text=query_text or "", filter=filter, top=top, vector_queries=vector_queries
             )
 
         documents = []
@@ -190,16 +340,16 @@ class Approach(ABC):
     def get_sources_content(
         self, results: List[Document], use_semantic_captions: bool, use_image_citation: bool
     ) -> list[str]:
+        # Each source line is formatted in a single pass, without intermediate concatenated strings
         if use_semantic_captions:
             return [
-                (self.get_citation((doc.sourcepage or ""), use_image_citation))
-                + ": "
-                + nonewlines(" . ".join([cast(str, c.text) for c in (doc.captions or [])]))
+                f"{self.get_citation(doc.sourcepage or '', use_image_citation)}: "
+                f"{nonewlines(' . '.join([cast(str, c.text) for c in (doc.captions or [])]))}"
                 for doc in results
             ]
         else:
             return [
-                (self.get_citation((doc.sourcepage or ""), use_image_citation)) + ": " + nonewlines(doc.content or "")
+                f"{self.get_citation(doc.sourcepage or '', use_image_citation)}: {nonewlines(doc.content or '')}"
                 for doc in results
             ]
 
@@ -225,35 +375,47 @@ class Approach(ABC):
         class ExtraArgs(TypedDict, total=False):
             dimensions: int
 
-        dimensions_args: ExtraArgs = (
-            {"dimensions": self.embedding_dimensions} if SUPPORTED_DIMENSIONS_MODEL[self.embedding_model] else {}
-        )
-        embedding = await self.openai_client.embeddings.create(
-            # Azure OpenAI takes the deployment name as the model name
-            model=self.embedding_deployment if self.embedding_deployment else self.embedding_model,
-            input=q,
-            **dimensions_args,
-        )
-        query_vector = embedding.data[0].embedding
+        async def create_embedding() -> List[float]:
+            dimensions_args: ExtraArgs = (
+                {"dimensions": self.embedding_dimensions} if SUPPORTED_DIMENSIONS_MODEL[self.embedding_model] else {}
+            )
+            embedding = await self.openai_client.embeddings.create(
+                # Azure OpenAI takes the deployment name as the model name
+                model=self.embedding_deployment if self.embedding_deployment else self.embedding_model,
+                input=q,
+                **dimensions_args,
+            )
+            return embedding.data[0].embedding
+
+        cache_key = ("text", self.embedding_deployment, self.embedding_model, self.embedding_dimensions, q)
+        query_vector = await query_embedding_cache.get_or_compute(cache_key, create_embedding)
         return VectorizedQuery(vector=query_vector, k_nearest_neighbors=50, fields="embedding")
 
     async def compute_image_embedding(self, q: str):
-        endpoint = urljoin(self.vision_endpoint, "computervision/retrieval:vectorizeText")
-        headers = {"Content-Type": "application/json"}
-        params = {"api-version": "2023-02-01-preview", "modelVersion": "latest"}
-        data = {"text": q}
-
-        headers["Authorization"] = "Bearer " + await self.vision_token_provider()
-
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                url=endpoint, params=params, headers=headers, json=data, raise_for_status=True
-            ) as response:
-                json = await response.json()
-                image_query_vector = json["vector"]
+        async def create_embedding() -> List[float]:
+            endpoint = urljoin(self.vision_endpoint, "computervision/retrieval:vectorizeText")
+            headers = {"Content-Type": "application/json"}
+            params = {"api-version": "2023-02-01-preview", "modelVersion": "latest"}
+            data = {"text": q}
+
+            headers["Authorization"] = "Bearer " + await self.vision_token_provider()
+
+            async with aiohttp.ClientSession() as session:
+                async with session.post(
+                    url=endpoint, params=params, headers=headers, json=data, raise_for_status=True
+                ) as response:
+                    json = await response.json()
+                    return json["vector"]
+
+        cache_key = ("image", self.vision_endpoint, q)
+        image_query_vector = await query_embedding_cache.get_or_compute(cache_key, create_embedding)
         return VectorizedQuery(vector=image_query_vector, k_nearest_neighbors=50, fields="imageEmbedding")
 
     async def run(
-        self, messages: list[dict], stream: bool = False, session_state: Any = None, context: dict[str, Any] = {}
+        self,
+        messages: list[dict],
+        stream: bool = False,
+        session_state: Any = None,
+        context: Optional[dict[str, Any]] = None,
     ) -> Union[dict[str, Any], AsyncGenerator[dict[str, Any], None]]:
         raise NotImplementedError
\ No newline at end of file
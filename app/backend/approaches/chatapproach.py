@@ -1,9 +1,12 @@
-import json
 import logging
 import re
 from abc import ABC, abstractmethod
-from typing import Any, AsyncGenerator, Optional, Union
+from bisect import bisect_right
+from functools import cached_property, lru_cache
+from itertools import accumulate
+from typing import Any, AsyncGenerator, NamedTuple, Optional, Sequence, Union
 
+import orjson
 from openai.types.chat import (
     ChatCompletion,
     ChatCompletionContentPartParam,
@@ -13,6 +16,29 @@ from openai.types.chat import (
 from approaches.approach import Approach
 from core.messagebuilder import MessageBuilder
 
+FOLLOWUP_QUESTIONS_PATTERN = re.compile(r"<<([^>>]+)>>")
+SOURCES_MARKER = "\n\nSources:\n"
+# The number of history messages counted first, doubled for each following batch
+FIRST_HISTORY_BATCH_SIZE = 8
+
+
+class _Msg(NamedTuple):
+    """A history message, kept as a tuple until it is handed to the MessageBuilder."""
+
+    role: str
+    content: str
+
+
+@lru_cache(maxsize=32)
+def _build_static_prefix(
+    system_prompt: str, model_id: str, few_shots_reversed: tuple[tuple[str, str], ...]
+) -> tuple[tuple[ChatCompletionMessageParam, ...], int]:
+    message_builder = MessageBuilder(system_prompt, model_id)
+    # Add examples to show the chat what responses we want. It will try to mimic any responses and make sure they match the rules laid out in the system message.
+    for role, content in few_shots_reversed:
+        message_builder.insert_message(role, content)
+    return tuple(message_builder.messages), sum(message_builder.count_tokens_for_messages(message_builder.messages))
+
 
 class ChatApproach(Approach, ABC):
     # Chat roles
@@ -46,7 +72,11 @@ class ChatApproach(Approach, ABC):
         {"role": USER, "content": "Quais são as formas de garantia de um contrato de locação?"},
         {"role": ASSISTANT, "content": "Identifique as formas de garantia de um contrato de locação"},
     ]
+    # Few-shots as (role, content) pairs, reversed once since they are inserted one by one right after the system message
+    _FEW_SHOTS_REVERSED = tuple((shot["role"], shot["content"]) for shot in reversed(query_prompt_few_shots))
     NO_RESPONSE = "0"
+    QUERY_PROMPT_CACHE_KEY = "query_rewrite_v1"
+    ANSWER_PROMPT_CACHE_KEY = "answer_v1"
 
     follow_up_questions_prompt_content = """Gere 3 perguntas de acompanhamento muito breves que o usuário provavelmente faria em seguida.
     Inclua as perguntas de acompanhamento entre duplos sinais de ângulo. Exemplo:
@@ -75,8 +105,20 @@ class ChatApproach(Approach, ABC):
     async def run_until_final_call(self, history, overrides, auth_claims, should_stream) -> tuple:
         pass
 
+    @cached_property
+    def default_system_prompts(self) -> dict[str, str]:
+        # Without an override prompt, the system prompt only varies with the follow-up questions prompt
+        return {
+            follow_up_questions_prompt: self.system_message_chat_conversation.format(
+                injected_prompt="", follow_up_questions_prompt=follow_up_questions_prompt
+            )
+            for follow_up_questions_prompt in ("", self.follow_up_questions_prompt_content)
+        }
+
     def get_system_prompt(self, override_prompt: Optional[str], follow_up_questions_prompt: str) -> str:
         if override_prompt is None:
+            if follow_up_questions_prompt in self.default_system_prompts:
+                return self.default_system_prompts[follow_up_questions_prompt]
             return self.system_message_chat_conversation.format(
                 injected_prompt="", follow_up_questions_prompt=follow_up_questions_prompt
             )
@@ -87,6 +129,21 @@ class ChatApproach(Approach, ABC):
         else:
             return override_prompt.format(follow_up_questions_prompt=follow_up_questions_prompt)
 
+    def get_prompt_cache_body(self, prompt_cache_key: str) -> Optional[dict[str, Any]]:
+        # The system prompt and few-shots are sent first and byte-identical on every request, so the provider
+        # caches that prefix automatically. The cache key only improves routing on OpenAI itself. Azure OpenAI and
+        # some local OpenAI-compatible servers reject it.
+        if self.openai_host != "openai":
+            return None
+        return {"prompt_cache_key": prompt_cache_key}
+
+    def log_prompt_cache_usage(self, chat_completion: ChatCompletion, step: str):
+        if chat_completion.usage is None:
+            return
+        usage = chat_completion.usage.model_dump()
+        cached_tokens = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+        logging.info("%s used %d cached of %d prompt tokens", step, cached_tokens, usage["prompt_tokens"])
+
     def get_search_query(self, chat_completion: ChatCompletion, user_query: str):
         response_message = chat_completion.choices[0].message
 
@@ -96,7 +153,7 @@ class ChatApproach(Approach, ABC):
                     continue
                 function = tool.function
                 if function.name == "search_sources":
-                    arg = json.loads(function.arguments)
+                    arg = orjson.loads(function.arguments)
                     search_query = arg.get("search_query", self.NO_RESPONSE)
                     if search_query != self.NO_RESPONSE:
                         return search_query
@@ -106,7 +163,7 @@ class ChatApproach(Approach, ABC):
         return user_query
 
     def extract_followup_questions(self, content: str):
-        return content.split("<<")[0], re.findall(r"<<([^>>]+)>>", content)
+        return content.split("<<")[0], FOLLOWUP_QUESTIONS_PATTERN.findall(content)
 
     def get_messages_from_history(
         self,
@@ -115,30 +172,41 @@ class ChatApproach(Approach, ABC):
         history: list[dict[str, str]],
         user_content: Union[str, list[ChatCompletionContentPartParam]],
         max_tokens: int,
-        few_shots=[],
+        few_shots_reversed: Sequence[tuple[str, str]] = (),
     ) -> list[ChatCompletionMessageParam]:
-        message_builder = MessageBuilder(system_prompt, model_id)
-
-        # Add examples to show the chat what responses we want. It will try to mimic any responses and make sure they match the rules laid out in the system message.
-        for shot in reversed(few_shots):
-            message_builder.insert_message(shot.get("role"), shot.get("content"))
+        # The system prompt and few-shots are the same across requests, so their messages and token count are built once
+        prefix_messages, prefix_token_count = _build_static_prefix(system_prompt, model_id, tuple(few_shots_reversed))
+        message_builder = MessageBuilder.from_prefilled(prefix_messages, model_id)
 
-        append_index = len(few_shots) + 1
+        append_index = len(few_shots_reversed) + 1
 
         message_builder.insert_message(self.USER, user_content, index=append_index)
 
-        total_token_count = 0
-        for existing_message in message_builder.messages:
-            total_token_count += message_builder.count_tokens_for_message(existing_message)
+        total_token_count = prefix_token_count + message_builder.count_tokens_for_message(
+            message_builder.messages[append_index]
+        )
 
-        newest_to_oldest = list(reversed(history[:-1]))
-        for message in newest_to_oldest:
-            potential_message_count = message_builder.count_tokens_for_message(message)
-            if (total_token_count + potential_message_count) > max_tokens:
-                logging.info("Reached max tokens of %d, history will be truncated", max_tokens)
+        # Walk the history from newest to oldest, skipping the last message which is the current question
+        newest_history = [_Msg(message["role"], message["content"]) for message in reversed(history[:-1])]
+
+        # The history is counted in growing batches, so that counting stops once the token budget is exhausted.
+        # Token counts only grow as older messages are added, so the cutoff in a batch is found with a binary search.
+        remaining_token_count = max_tokens - total_token_count
+        fitting_message_count = 0
+        batch_size = FIRST_HISTORY_BATCH_SIZE
+        while fitting_message_count < len(newest_history):
+            batch = newest_history[fitting_message_count : fitting_message_count + batch_size]
+            cumulative_token_counts = list(accumulate(message_builder.count_tokens_for_text_messages(batch)))
+            fitting_batch_count = bisect_right(cumulative_token_counts, remaining_token_count)
+            fitting_message_count += fitting_batch_count
+            if fitting_batch_count < len(batch):
                 break
-            message_builder.insert_message(message["role"], message["content"], index=append_index)
-            total_token_count += potential_message_count
+            remaining_token_count -= cumulative_token_counts[-1]
+            batch_size *= 2
+        if fitting_message_count < len(newest_history):
+            logging.info("Reached max tokens of %d, history will be truncated", max_tokens)
+        for history_message in newest_history[:fitting_message_count]:
+            message_builder.insert_message(history_message.role, history_message.content, index=append_index)
         return message_builder.messages
 
     async def run_without_streaming(
@@ -152,10 +220,14 @@ class ChatApproach(Approach, ABC):
             history, overrides, auth_claims, should_stream=False
         )
         chat_completion_response: ChatCompletion = await chat_coroutine
-        chat_resp = chat_completion_response.model_dump()  # Convert to dict to make it JSON serializable
+        self.log_prompt_cache_usage(chat_completion_response, "Answer generation")
+        # Convert to dict to make it JSON serializable, leaving out the unset optional fields
+        chat_resp = chat_completion_response.model_dump(exclude_none=True)
         chat_resp["choices"][0]["context"] = extra_info
         if overrides.get("suggest_followup_questions"):
-            content, followup_questions = self.extract_followup_questions(chat_resp["choices"][0]["message"]["content"])
+            content, followup_questions = self.extract_followup_questions(
+                chat_resp["choices"][0]["message"].get("content", "")
+            )
             chat_resp["choices"][0]["message"]["content"] = content
             chat_resp["choices"][0]["context"]["followup_questions"] = followup_questions
         chat_resp["choices"][0]["session_state"] = session_state
@@ -184,26 +256,29 @@ class ChatApproach(Approach, ABC):
             "object": "chat.completion.chunk",
         }
 
+        need_followup_scan = bool(overrides.get("suggest_followup_questions"))
         followup_questions_started = False
         followup_content = ""
         async for event_chunk in await chat_coroutine:
             # "2023-07-01-preview" API version has a bug where first response has empty choices
-            event = event_chunk.model_dump()  # Convert pydantic model to dict
-            if event["choices"]:
+            if event_chunk.choices:
+                content = event_chunk.choices[0].delta.content or ""  # content may be explicitly None
+                # Once the follow-up questions started, every remaining chunk belongs to them without scanning it
+                if followup_questions_started:
+                    followup_content += content
+                    continue
                 # if event contains << and not >>, it is start of follow-up question, truncate
-                content = event["choices"][0]["delta"].get("content")
-                content = content or ""  # content may either not exist in delta, or explicitly be None
-                if overrides.get("suggest_followup_questions") and "<<" in content:
+                if need_followup_scan and (followup_start := content.find("<<")) != -1:
                     followup_questions_started = True
-                    earlier_content = content[: content.index("<<")]
+                    earlier_content = content[:followup_start]
                     if earlier_content:
+                        event = event_chunk.model_dump()  # Convert pydantic model to dict
                         event["choices"][0]["delta"]["content"] = earlier_content
                         yield event
-                    followup_content += content[content.index("<<") :]
-                elif followup_questions_started:
-                    followup_content += content
+                    followup_content += content[followup_start:]
                 else:
-                    yield event
+                    # Only chunks that are sent to the client need to be converted to dict
+                    yield event_chunk.model_dump()
         if followup_content:
             _, followup_questions = self.extract_followup_questions(followup_content)
             yield {
@@ -219,8 +294,13 @@ class ChatApproach(Approach, ABC):
             }
 
     async def run(
-        self, messages: list[dict], stream: bool = False, session_state: Any = None, context: dict[str, Any] = {}
+        self,
+        messages: list[dict],
+        stream: bool = False,
+        session_state: Any = None,
+        context: Optional[dict[str, Any]] = None,
     ) -> Union[dict[str, Any], AsyncGenerator[dict[str, Any], None]]:
+        context = context or {}
         overrides = context.get("overrides", {})
         auth_claims = context.get("auth_claims", {})
 
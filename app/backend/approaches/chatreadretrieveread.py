@@ -10,7 +10,7 @@ from openai.types.chat import (
 )
 
 from approaches.approach import ThoughtStep
-from approaches.chatapproach import ChatApproach
+from approaches.chatapproach import SOURCES_MARKER, ChatApproach
 from core.authentication import AuthenticationHelper
 from core.modelhelper import get_token_limit
 
@@ -28,6 +28,7 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         search_client: SearchClient,
         auth_helper: AuthenticationHelper,
         openai_client: AsyncOpenAI,
+        openai_host: str,
         chatgpt_model: str,
         chatgpt_deployment: Optional[str],  # Not needed for non-Azure OpenAI
         embedding_deployment: Optional[str],  # Not needed for non-Azure OpenAI or for retrieval_mode="text"
@@ -40,6 +41,7 @@ class ChatReadRetrieveReadApproach(ChatApproach):
     ):
         self.search_client = search_client
         self.openai_client = openai_client
+        self.openai_host = openai_host
         self.auth_helper = auth_helper
         self.chatgpt_model = chatgpt_model
         self.chatgpt_deployment = chatgpt_deployment
@@ -90,13 +92,13 @@ class ChatReadRetrieveReadApproach(ChatApproach):
     ) -> tuple[dict[str, Any], Coroutine[Any, Any, Union[ChatCompletion, AsyncStream[ChatCompletionChunk]]]]:
         has_text = overrides.get("retrieval_mode") in ["text", "hybrid", None]
         has_vector = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
-        use_semantic_captions = True if overrides.get("semantic_captions") and has_text else False
+        use_semantic_captions = bool(overrides.get("semantic_captions") and has_text)
         top = overrides.get("top", 3)
         minimum_search_score = overrides.get("minimum_search_score", 0.01)
         minimum_reranker_score = overrides.get("minimum_reranker_score", 1.5)
 
         filter = self.build_filter(overrides, auth_claims)
-        use_semantic_ranker = True if overrides.get("semantic_ranker") and has_text else False
+        use_semantic_ranker = bool(overrides.get("semantic_ranker") and has_text)
 
         original_user_query = history[-1]["content"]
         user_query_request = "Generate search query for: " + original_user_query
@@ -122,13 +124,15 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         ]
 
         # STEP 1: Generate an optimized keyword search query based on the chat history and the last question
+        # The history budget already counts the tokens of the user request, so only reserve room for the response
+        query_response_token_limit = 100
         query_messages = self.get_messages_from_history(
             system_prompt=self.query_prompt_template,
             model_id=self.chatgpt_model,
             history=history,
             user_content=user_query_request,
-            max_tokens=self.chatgpt_token_limit - len(user_query_request),
-            few_shots=self.query_prompt_few_shots,
+            max_tokens=self.chatgpt_token_limit - query_response_token_limit,
+            few_shots_reversed=self._FEW_SHOTS_REVERSED,
         )
 
         chat_completion: ChatCompletion = await self.openai_client.chat.completions.create(
@@ -136,11 +140,13 @@ class ChatReadRetrieveReadApproach(ChatApproach):
             # Azure OpenAI takes the deployment name as the model name
             model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
             temperature=0.0,  # Minimize creativity for search query generation
-            max_tokens=100,  # Setting too low risks malformed JSON, setting too high may affect performance
+            max_tokens=query_response_token_limit,  # Setting too low risks malformed JSON, setting too high may affect performance
             n=1,
             tools=tools,
             tool_choice="auto",
+            extra_body=self.get_prompt_cache_body(self.QUERY_PROMPT_CACHE_KEY),
         )
+        self.log_prompt_cache_usage(chat_completion, "Search query generation")
 
         query_text = self.get_search_query(chat_completion, original_user_query)
 
@@ -186,7 +192,7 @@ class ChatReadRetrieveReadApproach(ChatApproach):
             model_id=self.chatgpt_model,
             history=history,
             # Model does not handle lengthy system messages well. Moving sources to latest user conversation to solve follow up questions prompt.
-            user_content=original_user_query + "\n\nSources:\n" + content,
+            user_content=f"{original_user_query}{SOURCES_MARKER}{content}",
             max_tokens=messages_token_limit,
         )
 
@@ -194,41 +200,46 @@ class ChatReadRetrieveReadApproach(ChatApproach):
 
         extra_info = {
             "data_points": data_points,
-            "thoughts": [
-                ThoughtStep(
-                    "Prompt to generate search query",
-                    [str(message) for message in query_messages],
-                    (
-                        {"model": self.chatgpt_model, "deployment": self.chatgpt_deployment}
-                        if self.chatgpt_deployment
-                        else {"model": self.chatgpt_model}
+            # Stringifying the prompts and serializing the results is skipped when the client does not show thoughts
+            "thoughts": (
+                [
+                    ThoughtStep(
+                        "Prompt to generate search query",
+                        [str(message) for message in query_messages],
+                        (
+                            {"model": self.chatgpt_model, "deployment": self.chatgpt_deployment}
+                            if self.chatgpt_deployment
+                            else {"model": self.chatgpt_model}
+                        ),
                     ),
-                ),
-                ThoughtStep(
-                    "Search using generated search query",
-                    query_text,
-                    {
-                        "use_semantic_captions": use_semantic_captions,
-                        "use_semantic_ranker": use_semantic_ranker,
-                        "top": top,
-                        "filter": filter,
-                        "has_vector": has_vector,
-                    },
-                ),
-                ThoughtStep(
-                    "Search results",
-                    [result.serialize_for_results() for result in results],
-                ),
-                ThoughtStep(
-                    "Prompt to generate answer",
-                    [str(message) for message in messages],
-                    (
-                        {"model": self.chatgpt_model, "deployment": self.chatgpt_deployment}
-                        if self.chatgpt_deployment
-                        else {"model": self.chatgpt_model}
+                    ThoughtStep(
+                        "Search using generated search query",
+                        query_text,
+                        {
+                            "use_semantic_captions": use_semantic_captions,
+                            "use_semantic_ranker": use_semantic_ranker,
+                            "top": top,
+                            "filter": filter,
+                            "has_vector": has_vector,
+                        },
+                    ),
+                    ThoughtStep(
+                        "Search results",
+                        [result.serialize_for_results() for result in results],
+                    ),
+                    ThoughtStep(
+                        "Prompt to generate answer",
+                        [str(message) for message in messages],
+                        (
+                            {"model": self.chatgpt_model, "deployment": self.chatgpt_deployment}
+                            if self.chatgpt_deployment
+                            else {"model": self.chatgpt_model}
+                        ),
                     ),
-                ),
-            ],
+                ]
+                if overrides.get("include_thoughts", True)
+                else []
+            ),
         }
 
         chat_coroutine = self.openai_client.chat.completions.create(
@@ -239,5 +250,9 @@ class ChatReadRetrieveReadApproach(ChatApproach):
             max_tokens=response_token_limit,
             n=1,
             stream=should_stream,
+            # The system prompt only varies with the follow-up questions instructions, which get their own cache key
+            extra_body=self.get_prompt_cache_body(
+                f"{self.ANSWER_PROMPT_CACHE_KEY}_{bool(overrides.get('suggest_followup_questions'))}"
+            ),
         )
         return (extra_info, chat_coroutine)
\ No newline at end of file
@@ -1,3 +1,4 @@
+import asyncio
 from typing import Any, Awaitable, Callable, Coroutine, Optional, Union
 
 from azure.search.documents.aio import SearchClient
@@ -8,10 +9,11 @@ from openai.types.chat import (
     ChatCompletionChunk,
     ChatCompletionContentPartImageParam,
     ChatCompletionContentPartParam,
+    ChatCompletionContentPartTextParam,
 )
 
 from approaches.approach import ThoughtStep
-from approaches.chatapproach import ChatApproach
+from approaches.chatapproach import SOURCES_MARKER, ChatApproach
 from core.authentication import AuthenticationHelper
 from core.imageshelper import fetch_image
 from core.modelhelper import get_token_limit
@@ -30,6 +32,7 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         search_client: SearchClient,
         blob_container_client: ContainerClient,
         openai_client: AsyncOpenAI,
+        openai_host: str,
         auth_helper: AuthenticationHelper,
         gpt4v_deployment: Optional[str],  # Not needed for non-Azure OpenAI
         gpt4v_model: str,
@@ -46,6 +49,7 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         self.search_client = search_client
         self.blob_container_client = blob_container_client
         self.openai_client = openai_client
+        self.openai_host = openai_host
         self.auth_helper = auth_helper
         self.gpt4v_deployment = gpt4v_deployment
         self.gpt4v_model = gpt4v_model
@@ -87,12 +91,12 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         has_text = overrides.get("retrieval_mode") in ["text", "hybrid", None]
         has_vector = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
         vector_fields = overrides.get("vector_fields", ["embedding"])
-        use_semantic_captions = True if overrides.get("semantic_captions") and has_text else False
+        use_semantic_captions = bool(overrides.get("semantic_captions") and has_text)
         top = overrides.get("top", 3)
         minimum_search_score = overrides.get("minimum_search_score", 0.0)
         minimum_reranker_score = overrides.get("minimum_reranker_score", 0.0)
         filter = self.build_filter(overrides, auth_claims)
-        use_semantic_ranker = True if overrides.get("semantic_ranker") and has_text else False
+        use_semantic_ranker = bool(overrides.get("semantic_ranker") and has_text)
 
         include_gtpV_text = overrides.get("gpt4v_input") in ["textAndImages", "texts", None]
         include_gtpV_images = overrides.get("gpt4v_input") in ["textAndImages", "images", None]
@@ -100,6 +104,8 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         original_user_query = history[-1]["content"]
 
         # STEP 1: Generate an optimized keyword search query based on the chat history and the last question
+        # The history budget already counts the tokens of the user request, so only reserve room for the response
+        query_response_token_limit = 100
         user_query_request = "Generate search query for: " + original_user_query
 
         query_messages = self.get_messages_from_history(
@@ -107,17 +113,19 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
             model_id=self.gpt4v_model,
             history=history,
             user_content=user_query_request,
-            max_tokens=self.chatgpt_token_limit - len(" ".join(user_query_request)),
-            few_shots=self.query_prompt_few_shots,
+            max_tokens=self.chatgpt_token_limit - query_response_token_limit,
+            few_shots_reversed=self._FEW_SHOTS_REVERSED,
         )
 
         chat_completion: ChatCompletion = await self.openai_client.chat.completions.create(
             model=self.gpt4v_deployment if self.gpt4v_deployment else self.gpt4v_model,
             messages=query_messages,
             temperature=0.0,  # Minimize creativity for search query generation
-            max_tokens=100,
+            max_tokens=query_response_token_limit,
             n=1,
+            extra_body=self.get_prompt_cache_body(self.QUERY_PROMPT_CACHE_KEY),
         )
+        self.log_prompt_cache_usage(chat_completion, "Search query generation")
 
         query_text = self.get_search_query(chat_completion, original_user_query)
 
@@ -126,13 +134,16 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         # If retrieval mode includes vectors, compute an embedding for the query
         vectors = []
         if has_vector:
-            for field in vector_fields:
-                vector = (
-                    await self.compute_text_embedding(query_text)
+            # The embeddings are independent requests, so compute them concurrently
+            embedding_coroutines = [
+                (
+                    self.compute_text_embedding(query_text)
                     if field == "embedding"
-                    else await self.compute_image_embedding(query_text)
+                    else self.compute_image_embedding(query_text)
                 )
-                vectors.append(vector)
+                for field in vector_fields
+            ]
+            vectors = list(await asyncio.gather(*embedding_coroutines))
 
         # Only keep the text query if the retrieval mode uses text, otherwise drop it
         if not has_text:
@@ -149,7 +160,6 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
             minimum_reranker_score,
         )
         sources_content = self.get_sources_content(results, use_semantic_captions, use_image_citation=True)
-        content = "\n".join(sources_content)
 
         # STEP 3: Generate a contextual and content specific answer using the search results and chat history
 
@@ -162,17 +172,23 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         response_token_limit = 1024
         messages_token_limit = self.chatgpt_token_limit - response_token_limit
 
-        user_content: list[ChatCompletionContentPartParam] = [{"text": original_user_query, "type": "text"}]
-        image_list: list[ChatCompletionContentPartImageParam] = []
-
-        if include_gtpV_text:
-            user_content.append({"text": "\n\nSources:\n" + content, "type": "text"})
-        if include_gtpV_images:
-            for result in results:
-                url = await fetch_image(self.blob_container_client, result)
-                if url:
-                    image_list.append({"image_url": url, "type": "image_url"})
-            user_content.extend(image_list)
+        # Fetch all images first, so that the user content can be built in one go
+        urls = (
+            await asyncio.gather(*(fetch_image(self.blob_container_client, result) for result in results))
+            if include_gtpV_images
+            else []
+        )
+        image_list: list[ChatCompletionContentPartImageParam] = [
+            {"image_url": url, "type": "image_url"} for url in urls if url
+        ]
+        sources_text: list[ChatCompletionContentPartTextParam] = (
+            [{"text": SOURCES_MARKER + "\n".join(sources_content), "type": "text"}] if include_gtpV_text else []
+        )
+        user_content: list[ChatCompletionContentPartParam] = [
+            {"text": original_user_query, "type": "text"},
+            *sources_text,
+            *image_list,
+        ]
 
         messages = self.get_messages_from_history(
             system_prompt=system_message,
@@ -189,41 +205,46 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
 
         extra_info = {
             "data_points": data_points,
-            "thoughts": [
-                ThoughtStep(
-                    "Prompt to generate search query",
-                    [str(message) for message in query_messages],
-                    (
-                        {"model": self.gpt4v_model, "deployment": self.gpt4v_deployment}
-                        if self.gpt4v_deployment
-                        else {"model": self.gpt4v_model}
+            # Stringifying the prompts and serializing the results is skipped when the client does not show thoughts
+            "thoughts": (
+                [
+                    ThoughtStep(
+                        "Prompt to generate search query",
+                        [str(message) for message in query_messages],
+                        (
+                            {"model": self.gpt4v_model, "deployment": self.gpt4v_deployment}
+                            if self.gpt4v_deployment
+                            else {"model": self.gpt4v_model}
+                        ),
+                    ),
+                    ThoughtStep(
+                        "Search using generated search query",
+                        query_text,
+                        {
+                            "use_semantic_captions": use_semantic_captions,
+                            "use_semantic_ranker": use_semantic_ranker,
+                            "top": top,
+                            "filter": filter,
+                            "vector_fields": vector_fields,
+                        },
+                    ),
+                    ThoughtStep(
+                        "Search results",
+                        [result.serialize_for_results() for result in results],
                     ),
-                ),
-                ThoughtStep(
-                    "Search using generated search query",
-                    query_text,
-                    {
-                        "use_semantic_captions": use_semantic_captions,
-                        "use_semantic_ranker": use_semantic_ranker,
-                        "top": top,
-                        "filter": filter,
-                        "vector_fields": vector_fields,
-                    },
-                ),
-                ThoughtStep(
-                    "Search results",
-                    [result.serialize_for_results() for result in results],
-                ),
-                ThoughtStep(
-                    "Prompt to generate answer",
-                    [str(message) for message in messages],
-                    (
-                        {"model": self.gpt4v_model, "deployment": self.gpt4v_deployment}
-                        if self.gpt4v_deployment
-                        else {"model": self.gpt4v_model}
+                    ThoughtStep(
+                        "Prompt to generate answer",
+                        [str(message) for message in messages],
+                        (
+                            {"model": self.gpt4v_model, "deployment": self.gpt4v_deployment}
+                            if self.gpt4v_deployment
+                            else {"model": self.gpt4v_model}
+                        ),
                     ),
-                ),
-            ],
+                ]
+                if overrides.get("include_thoughts", True)
+                else []
+            ),
         }
 
         chat_coroutine = self.openai_client.chat.completions.create(
@@ -233,5 +254,9 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
             max_tokens=response_token_limit,
             n=1,
             stream=should_stream,
+            # The system prompt only varies with the follow-up questions instructions, which get their own cache key
+            extra_body=self.get_prompt_cache_body(
+                f"{self.ANSWER_PROMPT_CACHE_KEY}_{bool(overrides.get('suggest_followup_questions'))}"
+            ),
         )
         return (extra_info, chat_coroutine)
\ No newline at end of file
@@ -1,10 +1,16 @@
-from typing import Any, AsyncGenerator, Optional, Union
+from typing import Any, AsyncGenerator, Coroutine, Optional, Union, cast
 
+import orjson
 from azure.search.documents.aio import SearchClient
-from azure.search.documents.models import VectorQuery
-from openai import AsyncOpenAI
-
-from approaches.approach import Approach, ThoughtStep
+from azure.search.documents.models import VectorizedQuery, VectorQuery
+from openai import AsyncOpenAI, AsyncStream
+from openai.types.chat import (
+    ChatCompletion,
+    ChatCompletionChunk,
+    ChatCompletionMessageParam,
+)
+
+from approaches.approach import Approach, SemanticCache, ThoughtStep
 from core.authentication import AuthenticationHelper
 from core.messagebuilder import MessageBuilder
 
@@ -18,11 +24,11 @@ class RetrieveThenReadApproach(Approach):
 
     system_chat_template = (
         "Você é um assistente que fornece informações sobre ações trabalhistas e ações relacionadas à locação de imóveis."
-        + "Use 'você' para se referir ao indivíduo que faz as perguntas, mesmo que ele pergunte com 'eu'."
-        + "Responda à seguinte pergunta usando apenas os dados fornecidos nas fontes abaixo."
-        + "Para informações tabulares, retorne-as como uma tabela html. Não retorne no formato markdown."
-        + "Cada fonte tem um nome seguido por dois pontos e as informações reais, sempre inclua o nome da fonte para cada fato que você usar na resposta."
-        + "Se não puder responder usando as fontes abaixo, diga que não sabe. Use o exemplo abaixo para responder."
+        "Use 'você' para se referir ao indivíduo que faz as perguntas, mesmo que ele pergunte com 'eu'."
+        "Responda à seguinte pergunta usando apenas os dados fornecidos nas fontes abaixo."
+        "Para informações tabulares, retorne-as como uma tabela html. Não retorne no formato markdown."
+        "Cada fonte tem um nome seguido por dois pontos e as informações reais, sempre inclua o nome da fonte para cada fato que você usar na resposta."
+        "Se não puder responder usando as fontes abaixo, diga que não sabe. Use o exemplo abaixo para responder."
     )
 
     # shots/sample conversation
@@ -67,30 +73,54 @@ info4.pdf: Os empregadores devem cumprir rigorosamente os prazos estabelecidos p
         self.content_field = content_field
         self.query_language = query_language
         self.query_speller = query_speller
+        self.prefix_messages = self.build_prefix_messages(self.system_chat_template)
+        self.semantic_cache = SemanticCache(maxsize=256, min_similarity=0.97)
+
+    def build_prefix_messages(self, system_prompt: str) -> list[ChatCompletionMessageParam]:
+        message_builder = MessageBuilder(system_prompt, self.chatgpt_model)
+        message_builder.insert_message("assistant", self.answer)
+        message_builder.insert_message("user", self.question)
+        return message_builder.messages
+
+    async def _cached_embed(self, q: str) -> VectorizedQuery:
+        # Questions differing only in surrounding spaces share one embedding. Case is kept, since it matters for
+        # acronyms and names, so the cached embedding is always the one of the text that is embedded.
+        return await self.compute_text_embedding(q.strip())
 
     async def run(
         self,
         messages: list[dict],
-        stream: bool = False,  # Stream is not used in this approach
+        stream: bool = False,
         session_state: Any = None,
-        context: dict[str, Any] = {},
+        context: Optional[dict[str, Any]] = None,
     ) -> Union[dict[str, Any], AsyncGenerator[dict[str, Any], None]]:
         q = messages[-1]["content"]
+        context = context or {}
         overrides = context.get("overrides", {})
         auth_claims = context.get("auth_claims", {})
         has_text = overrides.get("retrieval_mode") in ["text", "hybrid", None]
         has_vector = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
         use_semantic_ranker = overrides.get("semantic_ranker") and has_text
 
-        use_semantic_captions = True if overrides.get("semantic_captions") and has_text else False
+        use_semantic_captions = bool(overrides.get("semantic_captions") and has_text)
         top = overrides.get("top", 3)
         minimum_search_score = overrides.get("minimum_search_score", 0.0)
         minimum_reranker_score = overrides.get("minimum_reranker_score", 0.0)
         filter = self.build_filter(overrides, auth_claims)
         # If retrieval mode includes vectors, compute an embedding for the query
-        vectors: list[VectorQuery] = []
-        if has_vector:
-            vectors.append(await self.compute_text_embedding(q))
+        query_embedding = await self._cached_embed(q) if has_vector else None
+        vectors: list[VectorQuery] = [query_embedding] if query_embedding else []
+
+        # Answers to near-identical earlier questions are reused when the filter and overrides are the same too
+        semantic_cache_key = (
+            orjson.dumps([filter, overrides], option=orjson.OPT_SORT_KEYS).decode()
+            if query_embedding and overrides.get("semantic_cache") and not stream
+            else None
+        )
+        if query_embedding and semantic_cache_key:
+            cached_answer = self.semantic_cache.get(query_embedding.vector, semantic_cache_key)
+            if cached_answer is not None:
+                return {**cached_answer, "choices": [{**cached_answer["choices"][0], "session_state": session_state}]}
 
         # Only keep the text query if the retrieval mode uses text, otherwise drop it
         query_text = q if has_text else None
@@ -106,64 +136,100 @@ info4.pdf: Os empregadores devem cumprir rigorosamente os prazos estabelecidos p
             minimum_reranker_score,
         )
 
-        user_content = [q]
-
-        template = overrides.get("prompt_template", self.system_chat_template)
-        model = self.chatgpt_model
-        message_builder = MessageBuilder(template, model)
+        # The system prompt and sample conversation are only rebuilt when the client overrides the prompt
+        prompt_template = overrides.get("prompt_template")
+        prefix_messages = (
+            self.prefix_messages if prompt_template is None else self.build_prefix_messages(prompt_template)
+        )
 
         # Process results
         sources_content = self.get_sources_content(results, use_semantic_captions, use_image_citation=False)
 
         # Append user message
-        content = "\n".join(sources_content)
-        user_content = q + "\n" + f"Sources:\n {content}"
-        message_builder.insert_message("user", user_content)
-        message_builder.insert_message("assistant", self.answer)
-        message_builder.insert_message("user", self.question)
+        sources_text = "\n".join(sources_content)
+        user_content = f"{q}\nSources:\n {sources_text}"
+        message_builder = MessageBuilder.from_prefilled(prefix_messages, self.chatgpt_model)
+        message_builder.insert_message("user", user_content, index=len(message_builder.messages))
         updated_messages = message_builder.messages
-        chat_completion = (
-            await self.openai_client.chat.completions.create(
-                # Azure OpenAI takes the deployment name as the model name
-                model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
-                messages=updated_messages,
-                temperature=overrides.get("temperature", 0.0),
-                max_tokens=1024,
-                n=1,
-            )
-        ).model_dump()
 
+        # The thoughts are built before the answer is requested, so that a stream can send them in its first event
         data_points = {"text": sources_content}
         extra_info = {
             "data_points": data_points,
-            "thoughts": [
-                ThoughtStep(
-                    "Search using user query",
-                    query_text,
-                    {
-                        "use_semantic_captions": use_semantic_captions,
-                        "use_semantic_ranker": use_semantic_ranker,
-                        "top": top,
-                        "filter": filter,
-                        "has_vector": has_vector,
-                    },
-                ),
-                ThoughtStep(
-                    "Search results",
-                    [result.serialize_for_results() for result in results],
-                ),
-                ThoughtStep(
-                    "Prompt to generate answer",
-                    [str(message) for message in updated_messages],
-                    (
-                        {"model": self.chatgpt_model, "deployment": self.chatgpt_deployment}
-                        if self.chatgpt_deployment
-                        else {"model": self.chatgpt_model}
+            # Serializing the search results is skipped when the client does not show thoughts
+            "thoughts": (
+                [
+                    ThoughtStep(
+                        "Search using user query",
+                        query_text,
+                        {
+                            "use_semantic_captions": use_semantic_captions,
+                            "use_semantic_ranker": use_semantic_ranker,
+                            "top": top,
+                            "filter": filter,
+                            "has_vector": has_vector,
+                        },
                     ),
-                ),
-            ],
+                    ThoughtStep(
+                        "Search results",
+                        [result.serialize_for_results() for result in results],
+                    ),
+                    ThoughtStep(
+                        "Prompt to generate answer",
+                        updated_messages,
+                        (
+                            {"model": self.chatgpt_model, "deployment": self.chatgpt_deployment}
+                            if self.chatgpt_deployment
+                            else {"model": self.chatgpt_model}
+                        ),
+                    ),
+                ]
+                if overrides.get("include_thoughts", True)
+                else []
+            ),
         }
 
+        chat_coroutine = self.openai_client.chat.completions.create(
+            # Azure OpenAI takes the deployment name as the model name
+            model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
+            messages=updated_messages,
+            temperature=overrides.get("temperature", 0.0),
+            max_tokens=1024,
+            n=1,
+            stream=stream,
+        )
+        if stream:
+            return self.run_with_streaming(
+                cast(Coroutine[Any, Any, AsyncStream[ChatCompletionChunk]], chat_coroutine), extra_info, session_state
+            )
+
+        chat_completion = cast(ChatCompletion, await chat_coroutine).model_dump()
         chat_completion["choices"][0]["context"] = extra_info
         chat_completion["choices"][0]["session_state"] = session_state
-        return chat_completion
\ No newline at end of file
+        if query_embedding and semantic_cache_key:
+            self.semantic_cache.add(query_embedding.vector, semantic_cache_key, chat_completion)
+        return chat_completion
+
+    async def run_with_streaming(
+        self,
+        chat_coroutine: Coroutine[Any, Any, AsyncStream[ChatCompletionChunk]],
+        extra_info: dict[str, Any],
+        session_state: Any = None,
+    ) -> AsyncGenerator[dict, None]:
+        yield {
+            "choices": [
+                {
+                    "delta": {"role": "assistant"},
+                    "context": extra_info,
+                    "session_state": session_state,
+                    "finish_reason": None,
+                    "index": 0,
+                }
+            ],
+            "object": "chat.completion.chunk",
+        }
+
+        async for event_chunk in await chat_coroutine:
+            # "2023-07-01-preview" API version has a bug where first response has empty choices
+            if event_chunk.choices:
+                yield event_chunk.model_dump()
@@ -23,13 +23,13 @@ class RetrieveThenReadVisionApproach(Approach):
 
     system_chat_template_gpt4v = (
         "You are an intelligent assistant helping analyze the Annual Financial Report of Contoso Ltd., The documents contain text, graphs, tables and images. "
-        + "Each image source has the file name in the top left corner of the image with coordinates (10,10) pixels and is in the format SourceFileName:<file_name> "
-        + "Each text source starts in a new line and has the file name followed by colon and the actual information "
-        + "Always include the source name from the image or text for each fact you use in the response in the format: [filename] "
-        + "Answer the following question using only the data provided in the sources below. "
-        + "For tabular information return it as an html table. Do not return markdown format. "
-        + "The text and image source can be the same file name, don't use the image title when citing the image source, only use the file name as mentioned "
-        + "If you cannot answer using the sources below, say you don't know. Return just the answer without any input texts "
+        "Each image source has the file name in the top left corner of the image with coordinates (10,10) pixels and is in the format SourceFileName:<file_name> "
+        "Each text source starts in a new line and has the file name followed by colon and the actual information "
+        "Always include the source name from the image or text for each fact you use in the response in the format: [filename] "
+        "Answer the following question using only the data provided in the sources below. "
+        "For tabular information return it as an html table. Do not return markdown format. "
+        "The text and image source can be the same file name, don't use the image title when citing the image source, only use the file name as mentioned "
+        "If you cannot answer using the sources below, say you don't know. Return just the answer without any input texts "
     )
 
     def __init__(
@@ -72,9 +72,10 @@ class RetrieveThenReadVisionApproach(Approach):
         messages: list[dict],
         stream: bool = False,  # Stream is not used in this approach
         session_state: Any = None,
-        context: dict[str, Any] = {},
+        context: Optional[dict[str, Any]] = None,
     ) -> Union[dict[str, Any], AsyncGenerator[dict[str, Any], None]]:
         q = messages[-1]["content"]
+        context = context or {}
         overrides = context.get("overrides", {})
         auth_claims = context.get("auth_claims", {})
         has_text = overrides.get("retrieval_mode") in ["text", "hybrid", None]
@@ -84,7 +85,7 @@ class RetrieveThenReadVisionApproach(Approach):
         include_gtpV_text = overrides.get("gpt4v_input") in ["textAndImages", "texts", None]
         include_gtpV_images = overrides.get("gpt4v_input") in ["textAndImages", "images", None]
 
-        use_semantic_captions = True if overrides.get("semantic_captions") and has_text else False
+        use_semantic_captions = bool(overrides.get("semantic_captions") and has_text)
         top = overrides.get("top", 3)
         minimum_search_score = overrides.get("minimum_search_score", 0.0)
         minimum_reranker_score = overrides.get("minimum_reranker_score", 0.0)
@@ -176,7 +177,7 @@ class RetrieveThenReadVisionApproach(Approach):
                 ),
                 ThoughtStep(
                     "Prompt to generate answer",
-                    [str(message) for message in updated_messages],
+                    updated_messages,
                     (
                         {"model": self.gpt4v_model, "deployment": self.gpt4v_deployment}
                         if self.gpt4v_deployment
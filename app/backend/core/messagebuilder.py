@@ -1,5 +1,7 @@
 import unicodedata
-from collections.abc import Mapping
+from collections import OrderedDict
+from collections.abc import Mapping, Sequence
+from functools import lru_cache
 from typing import List, Union
 
 from openai.types.chat import (
@@ -10,7 +12,21 @@ from openai.types.chat import (
     ChatCompletionUserMessageParam,
 )
 
-from .modelhelper import num_tokens_from_messages
+from .modelhelper import num_tokens_from_messages, num_tokens_from_text_messages
+
+# Few-shots, system prompts and history are re-counted on every request, so memoize plain text messages
+TEXT_MESSAGE_TOKEN_COUNTS_MAXSIZE = 512
+_text_message_token_counts: OrderedDict[tuple[str, str, str], int] = OrderedDict()
+
+
+@lru_cache(maxsize=64)
+def _normalize_system_content(system_content: str) -> str:
+    # System prompts are long and the same across requests, so each one is only normalized once
+    return unicodedata.normalize("NFC", system_content)
+
+
+def _is_text_message(message: Mapping[str, object]) -> bool:
+    return len(message) == 2 and isinstance(message.get("role"), str) and isinstance(message.get("content"), str)
 
 
 class MessageBuilder:
@@ -27,10 +43,26 @@ class MessageBuilder:
 
     def __init__(self, system_content: str, chatgpt_model: str):
         self.messages: list[ChatCompletionMessageParam] = [
-            ChatCompletionSystemMessageParam(role="system", content=unicodedata.normalize("NFC", system_content))
+            ChatCompletionSystemMessageParam(role="system", content=_normalize_system_content(system_content))
         ]
         self.model = chatgpt_model
 
+    @classmethod
+    def from_prefilled(
+        cls, prefix_messages: Sequence[ChatCompletionMessageParam], chatgpt_model: str
+    ) -> "MessageBuilder":
+        """
+        Creates a MessageBuilder starting with messages that were already built and normalized,
+        such as a system prompt and sample conversation shared by every request.
+        Args:
+            prefix_messages (Sequence[ChatCompletionMessageParam]): The messages to start with, system message first.
+            chatgpt_model (str): The name of the ChatGPT model.
+        """
+        message_builder = cls.__new__(cls)
+        message_builder.messages = list(prefix_messages)
+        message_builder.model = chatgpt_model
+        return message_builder
+
     def insert_message(self, role: str, content: Union[str, List[ChatCompletionContentPartParam]], index: int = 1):
         """
         Inserts a message into the conversation at the specified index,
@@ -54,7 +86,57 @@ class MessageBuilder:
         self.messages.insert(index, message)
 
     def count_tokens_for_message(self, message: Mapping[str, object]):
-        return num_tokens_from_messages(message, self.model)
+        return self.count_tokens_for_messages([message])[0]
+
+    def count_tokens_for_messages(self, messages: Sequence[Mapping[str, object]]) -> list[int]:
+        """
+        Counts the tokens of each message. Text messages that were not counted before are encoded in a single batch.
+        Args:
+            messages (Sequence[Mapping]): The messages to count.
+        """
+        token_counts: list[int] = [0] * len(messages)
+        text_indexes: list[int] = []
+        text_messages: list[tuple[str, str]] = []
+        for i, message in enumerate(messages):
+            if _is_text_message(message):
+                text_indexes.append(i)
+                text_messages.append((str(message["role"]), str(message["content"])))
+            else:
+                token_counts[i] = num_tokens_from_messages(message, self.model)
+        for i, token_count in zip(text_indexes, self.count_tokens_for_text_messages(text_messages)):
+            token_counts[i] = token_count
+        return token_counts
+
+    def count_tokens_for_text_messages(self, messages: Sequence[tuple[str, str]]) -> list[int]:
+        """
+        Counts the tokens of each text message given as a (role, content) pair, without building a dict for it.
+        Args:
+            messages (Sequence[tuple[str, str]]): The (role, content) pairs to count.
+        """
+        token_counts: list[int] = [0] * len(messages)
+        uncounted_indexes: list[int] = []
+        uncounted_messages: list[tuple[str, str]] = []
+        for i, (role, content) in enumerate(messages):
+            key = (self.model, role, content)
+            token_count = _text_message_token_counts.get(key)
+            if token_count is None:
+                uncounted_indexes.append(i)
+                uncounted_messages.append((role, content))
+            else:
+                _text_message_token_counts.move_to_end(key)
+                token_counts[i] = token_count
+
+        if uncounted_messages:
+            for i, (role, content), token_count in zip(
+                uncounted_indexes,
+                uncounted_messages,
+                num_tokens_from_text_messages(uncounted_messages, self.model),
+            ):
+                token_counts[i] = token_count
+                _text_message_token_counts[(self.model, role, content)] = token_count
+            while len(_text_message_token_counts) > TEXT_MESSAGE_TOKEN_COUNTS_MAXSIZE:
+                _text_message_token_counts.popitem(last=False)
+        return token_counts
 
     def normalize_content(self, content: Union[str, List[ChatCompletionContentPartParam]]):
         if isinstance(content, str):
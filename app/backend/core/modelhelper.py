@@ -1,6 +1,7 @@
 from __future__ import annotations
 
-from collections.abc import Mapping
+from collections.abc import Mapping, Sequence
+from functools import lru_cache
 
 import tiktoken
 
@@ -19,7 +20,11 @@ MODELS_2_TOKEN_LIMITS = {
 
 AOAI_2_OAI = {"gpt-35-turbo": "gpt-3.5-turbo", "gpt-35-turbo-16k": "gpt-3.5-turbo-16k", "gpt-4v": "gpt-4-turbo-vision"}
 
+# Below this many texts, the thread pool started by encode_batch costs more than encoding the texts one by one
+MIN_TEXTS_FOR_BATCH_ENCODING = 8
 
+
+@lru_cache(maxsize=32)
 def get_token_limit(model_id: str) -> int:
     if model_id not in MODELS_2_TOKEN_LIMITS:
         raise ValueError(f"Expected model gpt-35-turbo and above. Received: {model_id}")
@@ -41,28 +46,57 @@ def num_tokens_from_messages(message: Mapping[str, object], model: str) -> int:
         output: 11
     """
 
-    encoding = tiktoken.encoding_for_model(get_oai_chatmodel_tiktok(model))
     num_tokens = 2  # For "role" and "content" keys
+    # The texts of all values are encoded together, so that the sources of a long message are encoded in one batch
+    texts: list[str] = []
     for value in message.values():
         if isinstance(value, list):
             # For GPT-4-vision support, based on https://github.com/openai/openai-cookbook/pull/881/files
             for item in value:
-                num_tokens += len(encoding.encode(item["type"]))
+                texts.append(item["type"])
                 if item["type"] == "text":
-                    num_tokens += len(encoding.encode(item["text"]))
+                    texts.append(item["text"])
                 elif item["type"] == "image_url":
                     num_tokens += calculate_image_token_cost(item["image_url"]["url"], item["image_url"]["detail"])
         elif isinstance(value, str):
-            num_tokens += len(encoding.encode(value))
+            texts.append(value)
         else:
             raise ValueError(f"Could not encode unsupported message value type: {type(value)}")
-    return num_tokens
+    return num_tokens + sum(len(encoded_text) for encoded_text in _encode_texts(texts, model))
+
 
+def num_tokens_from_text_messages(messages: Sequence[tuple[str, str]], model: str) -> list[int]:
+    """
+    Calculate the number of tokens required to encode each of several text messages, encoding them in one batch.
+    Args:
+        messages (Sequence): The (role, content) pairs of the messages to encode.
+        model (str): The name of the model to use for encoding.
+    Returns:
+        list[int]: The number of tokens required to encode each message, as num_tokens_from_messages would count them.
+    """
 
+    encoded_texts = _encode_texts([text for message in messages for text in message], model)
+    # For "role" and "content" keys, then the encoded role and content of each message
+    return [2 + len(encoded_texts[2 * i]) + len(encoded_texts[2 * i + 1]) for i in range(len(messages))]
+
+
+@lru_cache(maxsize=32)
 def get_oai_chatmodel_tiktok(aoaimodel: str) -> str:
     message = "Expected Azure OpenAI ChatGPT model name"
     if aoaimodel == "" or aoaimodel is None:
         raise ValueError(message)
     if aoaimodel not in AOAI_2_OAI and aoaimodel not in MODELS_2_TOKEN_LIMITS:
         raise ValueError(message)
-    return AOAI_2_OAI.get(aoaimodel, aoaimodel)
\ No newline at end of file
+    return AOAI_2_OAI.get(aoaimodel, aoaimodel)
+
+
+@lru_cache(maxsize=16)
+def _get_encoding(model: str) -> tiktoken.Encoding:
+    return tiktoken.encoding_for_model(get_oai_chatmodel_tiktok(model))
+
+
+def _encode_texts(texts: list[str], model: str) -> list[list[int]]:
+    encoding = _get_encoding(model)
+    if len(texts) >= MIN_TEXTS_FOR_BATCH_ENCODING:
+        return encoding.encode_batch(texts)
+    return [encoding.encode(text) for text in texts]
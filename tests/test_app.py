@@ -171,6 +171,43 @@ async def test_ask_rtr_text(client, snapshot):
     snapshot.assert_match(json.dumps(result, indent=4), "result.json")
 
 
+@pytest.mark.asyncio
+async def test_ask_rtr_text_stream(client):
+    response = await client.post(
+        "/ask",
+        json={
+            "stream": True,
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {
+                "overrides": {"retrieval_mode": "text"},
+            },
+        },
+    )
+    assert response.status_code == 200
+    assert response.mimetype == "application/json-lines"
+    events = [json.loads(line) for line in (await response.get_data(as_text=True)).splitlines()]
+    assert events[0]["choices"][0]["context"]["data_points"]["text"]
+    answer = "".join(event["choices"][0]["delta"].get("content") or "" for event in events[1:])
+    assert answer == "The capital of France is Paris. [Benefit_Options-2.pdf]."
+
+
+@pytest.mark.asyncio
+async def test_ask_rtr_text_without_thoughts(client):
+    response = await client.post(
+        "/ask",
+        json={
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {
+                "overrides": {"retrieval_mode": "text", "include_thoughts": False},
+            },
+        },
+    )
+    assert response.status_code == 200
+    result = await response.get_json()
+    assert result["choices"][0]["context"]["thoughts"] == []
+    assert result["choices"][0]["context"]["data_points"]["text"]
+
+
 @pytest.mark.asyncio
 async def test_ask_rtr_text_filter(auth_client, snapshot):
     response = await auth_client.post(
@@ -335,6 +372,23 @@ async def test_chat_text(client, snapshot):
     snapshot.assert_match(json.dumps(result, indent=4), "result.json")
 
 
+@pytest.mark.asyncio
+async def test_chat_text_without_thoughts(client):
+    response = await client.post(
+        "/chat",
+        json={
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {
+                "overrides": {"retrieval_mode": "text", "include_thoughts": False},
+            },
+        },
+    )
+    assert response.status_code == 200
+    result = await response.get_json()
+    assert result["choices"][0]["context"]["thoughts"] == []
+    assert result["choices"][0]["context"]["data_points"]["text"]
+
+
 @pytest.mark.asyncio
 async def test_chat_text_filter(auth_client, snapshot):
     response = await auth_client.post(
@@ -5,6 +5,7 @@ from azure.core.credentials import AzureKeyCredential
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.indexes.models import SearchField, SearchIndex
 
+from approaches.approach import Approach
 from core.authentication import AuthenticationHelper, AuthError
 
 from .mocks import MockAsyncPageIterator
@@ -164,6 +165,35 @@ def test_build_security_filters(mock_confidential_client_success, mock_validate_
     )
 
 
+class KeyRecordingDict(dict):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.read_keys = set()
+
+    def get(self, key, default=None):
+        self.read_keys.add(key)
+        return super().get(key, default)
+
+    def __getitem__(self, key):
+        self.read_keys.add(key)
+        return super().__getitem__(key)
+
+
+def test_build_security_filters_reads_only_filter_key_fields(
+    mock_confidential_client_success, mock_validate_token_success
+):
+    # Approach caches filters by _filter_key, so it must cover every field that build_security_filters reads
+    overrides = {"use_oid_security_filter": True, "use_groups_security_filter": True}
+    auth_claims = {"oid": "OID_X", "groups": ["GROUP_Y", "GROUP_Z"]}
+    filter_key_overrides, filter_key_claims = KeyRecordingDict(overrides), KeyRecordingDict(auth_claims)
+    Approach._filter_key(filter_key_overrides, filter_key_claims)
+    for require_access_control in (False, True):
+        security_overrides, security_claims = KeyRecordingDict(overrides), KeyRecordingDict(auth_claims)
+        create_authentication_helper(require_access_control).build_security_filters(security_overrides, security_claims)
+        assert security_overrides.read_keys <= filter_key_overrides.read_keys
+        assert security_claims.read_keys <= filter_key_claims.read_keys
+
+
 @pytest.mark.asyncio
 async def test_check_path_auth_denied(monkeypatch, mock_confidential_client_success, mock_validate_token_success):
     auth_helper_require_access_control = create_authentication_helper(require_access_control=True)
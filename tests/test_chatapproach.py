@@ -1,11 +1,19 @@
+import asyncio
 import json
 
+import numpy as np
 import pytest
 from azure.core.credentials import AzureKeyCredential
 from azure.search.documents.aio import SearchClient
+from openai import AsyncAzureOpenAI
+from openai.types import CreateEmbeddingResponse, Embedding
 from openai.types.chat import ChatCompletion
+from openai.types.create_embedding_response import Usage
 
+from approaches.approach import EmbeddingCache, SemanticCache
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
+from approaches.retrievethenread import RetrieveThenReadApproach
+from core.messagebuilder import MessageBuilder
 
 from .mocks import (
     MOCK_EMBEDDING_DIMENSIONS,
@@ -24,6 +32,7 @@ def chat_approach():
         search_client=None,
         auth_helper=None,
         openai_client=None,
+        openai_host="openai",
         chatgpt_model="gpt-35-turbo",
         chatgpt_deployment="chat",
         embedding_deployment="embeddings",
@@ -112,6 +121,20 @@ def test_get_search_query_returns_default(chat_approach):
     assert query == default_query
 
 
+def test_get_prompt_cache_body(chat_approach):
+    assert chat_approach.get_prompt_cache_body("query_rewrite_v1") == {"prompt_cache_key": "query_rewrite_v1"}
+
+
+def test_get_prompt_cache_body_azure(chat_approach):
+    chat_approach.openai_host = "azure"
+    assert chat_approach.get_prompt_cache_body("query_rewrite_v1") is None
+
+
+def test_get_prompt_cache_body_local(chat_approach):
+    chat_approach.openai_host = "local"
+    assert chat_approach.get_prompt_cache_body("query_rewrite_v1") is None
+
+
 def test_get_messages_from_history(chat_approach):
     messages = chat_approach.get_messages_from_history(
         system_prompt="You are a bot.",
@@ -190,6 +213,28 @@ def test_get_messages_from_history_truncated_longer(chat_approach):
     ]
 
 
+def test_get_messages_from_history_counts_long_history_in_batches(chat_approach, monkeypatch):
+    counted_batch_sizes = []
+
+    def mock_count_tokens_for_text_messages(self, messages):
+        counted_batch_sizes.append(len(messages))
+        return [100] * len(messages)
+
+    monkeypatch.setattr(MessageBuilder, "count_tokens_for_text_messages", mock_count_tokens_for_text_messages)
+    history = [{"role": "user" if i % 2 == 0 else "assistant", "content": f"Message {i}"} for i in range(101)]
+    messages = chat_approach.get_messages_from_history(
+        system_prompt="You are a bot.",
+        model_id="gpt-35-turbo",
+        history=history,
+        user_content="Message 100",
+        max_tokens=1050,
+    )
+    # The new user message is counted first. Only the 9 newest history messages fit, so counting stops after the
+    # second batch of history.
+    assert counted_batch_sizes == [1, 8, 16]
+    assert [message["content"] for message in messages[1:-1]] == [f"Message {i}" for i in range(91, 100)]
+
+
 def test_get_messages_from_history_truncated_break_pair(chat_approach):
     """Tests that the truncation breaks the pair of messages."""
     messages = chat_approach.get_messages_from_history(
@@ -300,7 +345,7 @@ def test_get_messages_from_history_few_shots(chat_approach):
         user_content=user_query_request,
         history=[],
         max_tokens=chat_approach.chatgpt_token_limit - len(user_query_request),
-        few_shots=chat_approach.query_prompt_few_shots,
+        few_shots_reversed=chat_approach._FEW_SHOTS_REVERSED,
     )
     # Make sure messages are in the right order
     assert messages[0]["role"] == "system"
@@ -333,6 +378,7 @@ async def test_search_results_filtering_by_scores(
         search_client=SearchClient(endpoint="", index_name="", credential=AzureKeyCredential("")),
         auth_helper=None,
         openai_client=None,
+        openai_host="openai",
         chatgpt_model="gpt-35-turbo",
         chatgpt_deployment="chat",
         embedding_deployment="embeddings",
@@ -359,4 +405,172 @@ async def test_search_results_filtering_by_scores(
 
     assert (
         len(filtered_results) == expected_result_count
-    ), f"Expected {expected_result_count} results with minimum_search_score={minimum_search_score} and minimum_reranker_score={minimum_reranker_score}"
\ No newline at end of file
+    ), f"Expected {expected_result_count} results with minimum_search_score={minimum_search_score} and minimum_reranker_score={minimum_reranker_score}"
+
+
+@pytest.mark.asyncio
+async def test_search_text_only_omits_vector_queries(monkeypatch):
+    search_kwargs = {}
+
+    async def mock_search_capturing_kwargs(*args, **kwargs):
+        search_kwargs.update(kwargs)
+        return await mock_search(*args, **kwargs)
+
+    chat_approach = ChatReadRetrieveReadApproach(
+        search_client=SearchClient(endpoint="", index_name="", credential=AzureKeyCredential("")),
+        auth_helper=None,
+        openai_client=None,
+        openai_host="openai",
+        chatgpt_model="gpt-35-turbo",
+        chatgpt_deployment="chat",
+        embedding_deployment="embeddings",
+        embedding_model=MOCK_EMBEDDING_MODEL_NAME,
+        embedding_dimensions=MOCK_EMBEDDING_DIMENSIONS,
+        sourcepage_field="",
+        content_field="",
+        query_language="en-us",
+        query_speller="lexicon",
+    )
+
+    monkeypatch.setattr(SearchClient, "search", mock_search_capturing_kwargs)
+
+    await chat_approach.search(
+        top=10,
+        query_text="test query",
+        filter=None,
+        vectors=[],
+        use_semantic_ranker=False,
+        use_semantic_captions=False,
+        minimum_search_score=0,
+        minimum_reranker_score=0,
+    )
+
+    assert search_kwargs["vector_queries"] is None
+
+
+def test_embedding_cache_evicts_least_recently_used():
+    cache = EmbeddingCache(maxsize=2)
+    cache.set(("text", "first"), [0.1])
+    cache.set(("text", "second"), [0.2])
+    assert cache.get(("text", "first")) == [0.1]
+    cache.set(("text", "third"), [0.3])
+    assert cache.get(("text", "second")) is None
+    assert cache.get(("text", "first")) == [0.1]
+    assert cache.get(("text", "third")) == [0.3]
+
+
+@pytest.mark.asyncio
+async def test_embedding_cache_computes_concurrent_misses_once():
+    cache = EmbeddingCache(maxsize=2)
+    calls = 0
+
+    async def compute():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0)
+        return [0.1]
+
+    results = await asyncio.gather(*(cache.get_or_compute(("text", "same"), compute) for _ in range(3)))
+    assert results == [[0.1], [0.1], [0.1]]
+    assert calls == 1
+    assert cache.in_flight == {}
+
+
+@pytest.mark.asyncio
+async def test_ask_embeds_each_casing_separately(monkeypatch, mock_openai_chatcompletion):
+    embedding_inputs = []
+    search_vectors = []
+
+    async def mock_embeddings_create(*args, **kwargs):
+        embedding_inputs.append(kwargs["input"])
+        # A different embedding for each casing of the question
+        uppercase_count = sum(character.isupper() for character in kwargs["input"])
+        return CreateEmbeddingResponse(
+            object="list",
+            data=[Embedding(embedding=[0.1, 0.2, float(uppercase_count)], index=0, object="embedding")],
+            model=MOCK_EMBEDDING_MODEL_NAME,
+            usage=Usage(prompt_tokens=8, total_tokens=8),
+        )
+
+    async def mock_search_capturing_vectors(*args, **kwargs):
+        search_vectors.append(kwargs.get("vector_queries"))
+        return await mock_search(*args, **kwargs)
+
+    class MockAuthHelper:
+        def build_security_filters(self, overrides, auth_claims):
+            return None
+
+    openai_client = AsyncAzureOpenAI(
+        api_key="key", api_version="2024-03-01-preview", azure_endpoint="https://test.openai.azure.com"
+    )
+    monkeypatch.setattr(openai_client.embeddings, "create", mock_embeddings_create)
+    mock_openai_chatcompletion(openai_client)
+    monkeypatch.setattr(SearchClient, "search", mock_search_capturing_vectors)
+    ask_approach = RetrieveThenReadApproach(
+        search_client=SearchClient(endpoint="", index_name="", credential=AzureKeyCredential("")),
+        auth_helper=MockAuthHelper(),
+        openai_client=openai_client,
+        chatgpt_model="gpt-35-turbo",
+        chatgpt_deployment="chat",
+        embedding_deployment="embeddings",
+        embedding_model=MOCK_EMBEDDING_MODEL_NAME,
+        embedding_dimensions=MOCK_EMBEDDING_DIMENSIONS,
+        sourcepage_field="",
+        content_field="",
+        query_language="en-us",
+        query_speller="lexicon",
+    )
+
+    context = {"overrides": {"retrieval_mode": "vectors"}}
+    questions = [
+        " Qual o prazo da CLT para o STF? ",
+        "qual o prazo da clt para o stf?",
+        "Qual o prazo da CLT para o STF?",
+    ]
+    for question in questions:
+        await ask_approach.run([{"role": "user", "content": question}], context=context)
+    # Only surrounding spaces are ignored, so the last question reuses the embedding of the first one
+    assert embedding_inputs == ["Qual o prazo da CLT para o STF?", "qual o prazo da clt para o stf?"]
+    assert [vectors[0].vector for vectors in search_vectors] == [[0.1, 0.2, 7.0], [0.1, 0.2, 0.0], [0.1, 0.2, 7.0]]
+
+
+def test_semantic_cache_reuses_close_answers_for_same_context():
+    cache = SemanticCache(maxsize=2, min_similarity=0.97)
+    cache.add([1.0, 0.0], "context", "first answer")
+    assert cache.get([0.99, 0.01], "context") == "first answer"
+    assert cache.get([0.99, 0.01], "other context") is None
+    assert cache.get([0.0, 1.0], "context") is None
+    cache.add([0.0, 1.0], "context", "second answer")
+    cache.add([0.7, 0.7], "context", "third answer")
+    # The oldest answer was evicted
+    assert cache.get([1.0, 0.0], "context") is None
+    assert cache.get([0.0, 1.0], "context") == "second answer"
+
+
+def test_semantic_cache_quantizes_embeddings():
+    cache = SemanticCache(maxsize=1, min_similarity=0.97)
+    embedding = [0.1 * (i % 7) - 0.3 for i in range(1536)]
+    cache.add(embedding, "context", "answer")
+    assert cache.embeddings is not None and cache.embeddings.dtype == np.int8
+    assert cache.get(embedding, "context") == "answer"
+    assert cache.get([-value for value in embedding], "context") is None
+
+
+def test_build_filter_is_cached_per_user(chat_approach):
+    class MockAuthHelper:
+        calls = 0
+
+        def build_security_filters(self, overrides, auth_claims):
+            self.calls += 1
+            return "oids/any(g:search.in(g, '{}'))".format(auth_claims["oid"])
+
+    chat_approach.auth_helper = MockAuthHelper()
+    overrides = {"exclude_category": "excluded", "use_oid_security_filter": True}
+    expected_filter = "category ne 'excluded' and oids/any(g:search.in(g, 'OID_X'))"
+    assert chat_approach.build_filter(overrides, {"oid": "OID_X", "groups": []}) == expected_filter
+    assert chat_approach.build_filter(overrides, {"oid": "OID_X", "groups": []}) == expected_filter
+    assert chat_approach.auth_helper.calls == 1
+    assert chat_approach.build_filter(overrides, {"oid": "OID_Y", "groups": []}) == (
+        "category ne 'excluded' and oids/any(g:search.in(g, 'OID_Y'))"
+    )
+    assert chat_approach.auth_helper.calls == 2
@@ -40,6 +40,7 @@ def chat_approach(openai_client, mock_confidential_client_success):
     return ChatReadRetrieveReadVisionApproach(
         search_client=None,
         openai_client=openai_client,
+        openai_host="azure",
         auth_helper=AuthenticationHelper(
             search_index=MockSearchIndex,
             use_authentication=True,
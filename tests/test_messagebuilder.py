@@ -46,4 +46,19 @@ def test_messagebuilder_unicode_append():
     ]
     assert builder.model == "gpt-35-turbo"
     assert builder.count_tokens_for_message(builder.messages[0]) == 4
-    assert builder.count_tokens_for_message(builder.messages[1]) == 4
\ No newline at end of file
+    assert builder.count_tokens_for_message(builder.messages[1]) == 4
+
+
+def test_messagebuilder_from_prefilled():
+    prefix_builder = MessageBuilder("You are a bot.", "gpt-35-turbo")
+    prefix_builder.insert_message("assistant", "An example answer")
+    message_builder = MessageBuilder.from_prefilled(prefix_builder.messages, "gpt-35-turbo")
+    message_builder.insert_message("user", "A question", index=len(message_builder.messages))
+    assert message_builder.messages == [
+        {"role": "system", "content": "You are a bot."},
+        {"role": "assistant", "content": "An example answer"},
+        {"role": "user", "content": "A question"},
+    ]
+    assert message_builder.model == "gpt-35-turbo"
+    # The prefix is copied, so it can be shared between requests
+    assert len(prefix_builder.messages) == 2